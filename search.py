@@ -1,60 +1,221 @@
-from typing import Any, Dict, List, Optional
+import asyncio
+import functools
+import hashlib
+import io
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import httpx
 from bs4 import BeautifulSoup
-import json
+import orjson
 import os
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlparse, urlsplit, urlunsplit
 from mcp.server.fastmcp import FastMCP
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+@asynccontextmanager
+async def close_http_clients(server: FastMCP) -> AsyncIterator[None]:
+    """Close the shared HTTP clients when the MCP server shuts down."""
+    global search_client, fetch_client
+    try:
+        yield
+    finally:
+        for client in (search_client, fetch_client):
+            if client is not None:
+                await client.aclose()
+        search_client = fetch_client = None
 # Initialize FastMCP server
-mcp = FastMCP("websearch")
+mcp = FastMCP("websearch", lifespan=close_http_clients)
 # Constants - You'll need to provide your own API keys
 SERPER_API_KEY = os.environ.get("SERPER_API_KEY", "your_serper_api_key")
 SERPER_API_URL = "https://google.serper.dev/search"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+MAIN_CONTENT_SELECTOR = "article, main, div[class*=content i], div[class*=article i]"
+EXTRACTION_TYPES = ("full_text", "main_content", "headings", "links")
+MAX_CONNECTIONS_PER_HOST = 8
+MAX_ATTEMPTS = 4
+MAX_BACKOFF = 30.0  # Longest retry wait in seconds; longer Retry-After values are not retried
+MAX_PAGE_BYTES = 512 * 1024  # Pages are truncated to this size before parsing
+PARSE_CACHE_SIZE = 128
+SUMMARY_LENGTH = 500
+MAX_KEY_POINTS = 10
+parse_cache: OrderedDict = OrderedDict()
+parse_cache_lock = threading.Lock()  # parse_page runs in worker threads
+host_semaphores: Dict[str, asyncio.Semaphore] = {}
+host_users: Dict[str, int] = {}  # Requests holding or waiting for each host's semaphore
+# Shared HTTP clients, created on first use so connections are pooled across tool calls
+search_client: Optional[httpx.AsyncClient] = None
+fetch_client: Optional[httpx.AsyncClient] = None
+def get_search_client() -> httpx.AsyncClient:
+    """Return the shared Serper API client, creating it on first use."""
+    global search_client
+    if search_client is None:
+        search_client = httpx.AsyncClient(
+            headers={
+                "X-API-KEY": SERPER_API_KEY,
+                "Content-Type": "application/json"
+            },
+            timeout=30.0,
+            http2=True
+        )
+    return search_client
+def get_fetch_client() -> httpx.AsyncClient:
+    """Return the shared webpage client, creating it on first use."""
+    global fetch_client
+    if fetch_client is None:
+        fetch_client = httpx.AsyncClient(
+            follow_redirects=True,
+            headers={
+                "User-Agent": USER_AGENT,
+                "Accept-Encoding": "gzip, br"
+            },
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=32)
+        )
+    return fetch_client
+def ttl_cache(maxsize: int, ttl: float, is_error: Callable[[Any], bool]) -> Callable:
+    """Cache an async function's results for ttl seconds in an LRU of maxsize entries, skipping errors."""
+    def decorator(func: Callable) -> Callable:
+        cache: OrderedDict = OrderedDict()
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            key = (args, tuple(sorted(kwargs.items())))
+            entry = cache.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if time.monotonic() < expires_at:
+                    cache.move_to_end(key)
+                    return result
+                del cache[key]
+            result = await func(*args, **kwargs)
+            # Errors are returned to the caller but never cached, so the next call retries
+            if not is_error(result):
+                cache[key] = (time.monotonic() + ttl, result)
+                cache.move_to_end(key)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+@asynccontextmanager
+async def host_slot(url: str) -> AsyncIterator[None]:
+    """Hold one of the URL host's request slots, dropping the host's semaphore once nobody uses it."""
+    host = urlparse(url).netloc
+    if host not in host_semaphores:
+        host_semaphores[host] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+    semaphore = host_semaphores[host]
+    host_users[host] = host_users.get(host, 0) + 1
+    try:
+        async with semaphore:
+            yield
+    finally:
+        host_users[host] -= 1
+        # Evict idle hosts so the dicts stay bounded on a long-running server
+        if not host_users[host]:
+            del host_users[host]
+            del host_semaphores[host]
+def get_retry_delay(response: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying, honoring Retry-After when the server sends it.
+    Returns None when Retry-After asks for longer than MAX_BACKOFF, so the caller gives up at once.
+    """
+    retry_after = response.headers.get("Retry-After")
+    delay = None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    if delay is None:
+        return min(MAX_BACKOFF, 0.5 * 2 ** attempt)
+    return max(0.0, delay) if delay <= MAX_BACKOFF else None
+async def send_with_retries(url: str, send: Callable[[], Awaitable[Any]]) -> Any:
+    """Run send() under the host's semaphore, retrying 429 and 5xx responses with exponential backoff."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            async with host_slot(url):
+                return await send()
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code
+            if attempt == MAX_ATTEMPTS - 1 or not (status_code == 429 or status_code >= 500):
+                raise
+            delay = get_retry_delay(e.response, attempt)
+            if delay is None:
+                raise
+        # Sleep outside the semaphore so other requests to the host can proceed
+        await asyncio.sleep(delay)
+@ttl_cache(maxsize=256, ttl=600, is_error=lambda result: "error" in result)
 async def make_search_request(query: str, num_results: int = 5) -> Dict[str, Any]:
     """Make a request to Serper API for Google search results."""
-    headers = {
-        "X-API-KEY": SERPER_API_KEY,
-        "Content-Type": "application/json"
-    }
     payload = {
         "q": query,
         "num": num_results
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                SERPER_API_URL,
-                headers=headers,
-                json=payload,
-                timeout=30.0
-            )
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            return {"error": str(e)}
+    async def send() -> Dict[str, Any]:
+        # The client already sends "Content-Type: application/json"
+        response = await get_search_client().post(SERPER_API_URL, content=orjson.dumps(payload))
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    try:
+        return await send_with_retries(SERPER_API_URL, send)
+    except Exception as e:
+        return {"error": str(e)}
+@ttl_cache(maxsize=512, ttl=900, is_error=lambda result: result.startswith("Error"))
 async def fetch_webpage_content(url: str) -> str:
     """Fetch content from a webpage with proper error handling."""
-    headers = {
-        "User-Agent": USER_AGENT
-    }
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        try:
-            response = await client.get(url, headers=headers, timeout=30.0)
+    async def send() -> str:
+        # Stream the body and stop reading once MAX_PAGE_BYTES have arrived
+        async with get_fetch_client().stream("GET", url) as response:
             response.raise_for_status()
-            return response.text
-        except Exception as e:
-            return f"Error fetching page: {str(e)}"
-def format_search_result(result: Dict[str, Any]) -> str:
-    """Format a search result into a readable string."""
-    title = result.get("title", "No title")
-    link = result.get("link", "No link")
-    snippet = result.get("snippet", "No description available")
-    return f"""
-Title: {title}
-URL: {link}
-Snippet: {snippet}
-"""
+            content = bytearray()
+            async for chunk in response.aiter_bytes():
+                content.extend(chunk)
+                if len(content) >= MAX_PAGE_BYTES:
+                    break
+            return content[:MAX_PAGE_BYTES].decode(response.encoding or "utf-8", errors="replace")
+    try:
+        return await send_with_retries(url, send)
+    except Exception as e:
+        return f"Error fetching page: {str(e)}"
+def canonicalize_url(url: str) -> str:
+    """Reduce a URL to scheme, host and path so variants of the same page compare equal."""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+def unique_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop search results without a link or whose canonical URL was already seen."""
+    seen = set()
+    unique = []
+    for result in results:
+        url = canonicalize_url(result.get("link") or "")
+        if url and url not in seen:
+            seen.add(url)
+            unique.append(result)
+    return unique
+def format_search_result(result: Dict[str, Any]) -> Tuple[str, str, str]:
+    """Extract the title, URL and snippet of a search result, with fallbacks for missing fields."""
+    return (
+        result.get("title", "No title"),
+        result.get("link", "No link"),
+        result.get("snippet", "No description available")
+    )
 @mcp.tool()
 async def web_search(query: str, num_results: int = 5) -> str:
     """
@@ -68,11 +229,107 @@ async def web_search(query: str, num_results: int = 5) -> str:
         return f"Error performing search: {search_results['error']}"
     if "organic" not in search_results or not search_results["organic"]:
         return "No results found for your query."
-    formatted_results = [
-        format_search_result(result)
-        for result in search_results["organic"][:num_results]
-    ]
-    return "\n---\n".join(formatted_results)
+    return "\n---\n".join(
+        f"\nTitle: {title}\nURL: {link}\nSnippet: {snippet}\n"
+        for title, link, snippet in map(format_search_result, search_results["organic"][:num_results])
+    )
+def parse_page(html_content: str) -> Dict[str, Any]:
+    """
+    Parse a page once and extract everything the tools report on.
+    Returns a dict with "headings" as (tag, text) pairs, "main_text", "full_text",
+    "summary" and "links" as (text, href) pairs. Results are cached by a hash of the HTML,
+    so callers must not mutate them.
+    """
+    key = hashlib.blake2b(html_content.encode(), digest_size=16).digest()
+    with parse_cache_lock:
+        page = parse_cache.get(key)
+        if page is not None:
+            parse_cache.move_to_end(key)
+            return page
+    if LexborHTMLParser is not None:
+        try:
+            page = parse_with_lexbor(html_content)
+        except Exception:
+            page = None  # Fall back to BeautifulSoup below
+    if page is None:
+        page = parse_with_beautifulsoup(html_content)
+    with parse_cache_lock:
+        parse_cache[key] = page
+        while len(parse_cache) > PARSE_CACHE_SIZE:
+            parse_cache.popitem(last=False)
+    return page
+def main_paragraphs_first(main_paragraphs: Iterable[Any], page_paragraphs: Callable[[], Iterable[Any]]) -> Iterator[Any]:
+    """Lazily yield the main content's paragraphs, or the whole page's if the main content has none."""
+    found = False
+    for paragraph in main_paragraphs:
+        found = True
+        yield paragraph
+    if not found:
+        yield from page_paragraphs()
+def build_summary(paragraphs: Iterable[str]) -> str:
+    """Join the leading paragraphs, stopping as soon as SUMMARY_LENGTH characters are collected."""
+    buffer = io.StringIO()
+    for paragraph in paragraphs:
+        if paragraph:
+            buffer.write(paragraph + " ")
+            if buffer.tell() >= SUMMARY_LENGTH:
+                break
+    return buffer.getvalue()[:SUMMARY_LENGTH].rstrip()
+def outermost_elements(elements: List[Any], get_id: Callable[[Any], Any], get_parent: Callable[[Any], Any]) -> List[Any]:
+    """Drop elements nested inside another element of the list, so their text is not repeated."""
+    ids = {get_id(element) for element in elements}
+    outermost = []
+    for element in elements:
+        parent = get_parent(element)
+        while parent is not None and get_id(parent) not in ids:
+            parent = get_parent(parent)
+        if parent is None:
+            outermost.append(element)
+    return outermost
+def lexbor_text(node: Any, separator: str) -> str:
+    """Join a Lexbor node's stripped text nodes, skipping empty ones like BeautifulSoup's get_text."""
+    # The HTML parser never emits NUL characters, so it safely marks text node boundaries
+    return separator.join([text for text in node.text(separator="\x00", strip=True).split("\x00") if text])
+def parse_with_lexbor(html_content: str) -> Dict[str, Any]:
+    """Extract page content with the Lexbor parser from selectolax."""
+    tree = LexborHTMLParser(html_content)
+    # Remove script and style elements
+    for node in tree.css("script, style"):
+        node.decompose()
+    main_elements = outermost_elements(tree.css(MAIN_CONTENT_SELECTOR), lambda node: node.mem_id, lambda node: node.parent)
+    # Summarize from paragraphs in the main content, falling back to any on the page
+    # Lazy so that build_summary stops querying once it has enough text
+    paragraphs = main_paragraphs_first(
+        itertools.chain.from_iterable(elem.css("p") for elem in main_elements),
+        lambda: tree.css("p")
+    )
+    return {
+        "headings": [(heading.tag, heading.text(strip=True)) for heading in tree.css("h1, h2, h3")],
+        "main_text": "\n\n".join([lexbor_text(elem, "\n") for elem in main_elements]),
+        "full_text": lexbor_text(tree.root, "\n"),
+        "summary": build_summary(lexbor_text(paragraph, " ") for paragraph in paragraphs),
+        "links": [(link.text(strip=True), link.attributes["href"] or "") for link in tree.css("a[href]")]
+    }
+def parse_with_beautifulsoup(html_content: str) -> Dict[str, Any]:
+    """Extract page content with BeautifulSoup, used when selectolax is unavailable or fails."""
+    soup = BeautifulSoup(html_content, HTML_PARSER)
+    # Remove script and style elements
+    for script in soup(["script", "style"]):
+        script.extract()
+    main_elements = outermost_elements(soup.select(MAIN_CONTENT_SELECTOR), id, lambda tag: tag.parent)
+    # Summarize from paragraphs in the main content, falling back to any on the page
+    # Lazy so that build_summary stops searching once it has enough text
+    paragraphs = main_paragraphs_first(
+        itertools.chain.from_iterable(elem.find_all('p') for elem in main_elements),
+        lambda: soup.find_all('p')
+    )
+    return {
+        "headings": [(heading.name, heading.get_text(strip=True)) for heading in soup.find_all(['h1', 'h2', 'h3'])],
+        "main_text": "\n\n".join([elem.get_text(separator="\n", strip=True) for elem in main_elements]),
+        "full_text": soup.get_text(separator="\n", strip=True),
+        "summary": build_summary(paragraph.get_text(separator=" ", strip=True) for paragraph in paragraphs),
+        "links": [(link.get_text(strip=True), link['href']) for link in soup.find_all('a', href=True)]
+    }
 @mcp.tool()
 async def fetch_and_parse_webpage(url: str, extraction_type: str = "full_text") -> str:
     """
@@ -82,42 +339,32 @@ async def fetch_and_parse_webpage(url: str, extraction_type: str = "full_text")
         extraction_type: Type of content to extract - "full_text", "main_content",
                         "headings", or "links" (default: "full_text")
     """
+    if extraction_type not in EXTRACTION_TYPES:
+        return f"Invalid extraction_type: {extraction_type}. Valid options are 'full_text', 'main_content', 'headings', or 'links'."
     html_content = await fetch_webpage_content(url)
     if html_content.startswith("Error"):
         return html_content
-    soup = BeautifulSoup(html_content, 'html.parser')
-    # Remove script and style elements
-    for script in soup(["script", "style"]):
-        script.extract()
+    # Parse in a worker thread so the event loop keeps serving other requests
+    page = await asyncio.to_thread(parse_page, html_content)
     if extraction_type == "full_text":
         # Get all text
-        text = soup.get_text(separator="\n", strip=True)
+        text = page["full_text"]
         return text[:10000] + "..." if len(text) > 10000 else text
     elif extraction_type == "main_content":
         # Try to find main content (simplified approach)
-        main_elements = soup.find_all(['article', 'main', 'div'], class_=lambda c: c and ('content' in c.lower() or 'article' in c.lower()))
-        if main_elements:
-            main_content = "\n\n".join([elem.get_text(separator="\n", strip=True) for elem in main_elements])
+        main_content = page["main_text"]
+        if main_content:
             return main_content[:10000] + "..." if len(main_content) > 10000 else main_content
         else:
             return "Couldn't identify main content. Try using full_text extraction instead."
     elif extraction_type == "headings":
         # Extract all headings
-        headings = []
-        for tag in ['h1', 'h2', 'h3']:
-            for heading in soup.find_all(tag):
-                headings.append(f"{tag.upper()}: {heading.get_text(strip=True)}")
+        headings = [f"{tag.upper()}: {text}" for tag, text in page["headings"]]
         return "\n".join(headings) if headings else "No headings found on the page."
-    elif extraction_type == "links":
-        # Extract all links
-        links = []
-        for link in soup.find_all('a', href=True):
-            text = link.get_text(strip=True) or "[No text]"
-            href = link['href']
-            links.append(f"{text}: {href}")
-        return "\n".join(links[:100]) if links else "No links found on the page."
     else:
-        return f"Invalid extraction_type: {extraction_type}. Valid options are 'full_text', 'main_content', 'headings', or 'links'."
+        # Extract all links
+        links = [f"{text or '[No text]'}: {href}" for text, href in page["links"][:100]]
+        return "\n".join(links) if links else "No links found on the page."
 @mcp.tool()
 async def deep_research(topic: str, depth: int = 2) -> str:
     """
@@ -130,64 +377,74 @@ async def deep_research(topic: str, depth: int = 2) -> str:
     search_results = await make_search_request(topic, depth + 2)
     if "error" in search_results:
         return f"Error performing search: {search_results['error']}"
-    if "organic" not in search_results or not search_results["organic"]:
+    # Skip duplicate pages so each fetched source is parsed only once
+    results = unique_results(search_results.get("organic") or [])
+    if not results:
         return "No results found for your topic."
     # Structure for the research report
     research_report = [f"# Deep Research: {topic}\n"]
     research_report.append("## Search Results Overview\n")
     # Add search results summary
-    for i, result in enumerate(search_results["organic"][:depth + 2]):
+    for i, result in enumerate(results[:depth + 2]):
         research_report.append(f"{i+1}. **{result.get('title', 'No title')}**")
         research_report.append(f"   URL: {result.get('link', 'No link')}")
         research_report.append(f"   Summary: {result.get('snippet', 'No description')}\n")
     # Now explore the top results in depth
     research_report.append("## Detailed Content Analysis\n")
-    for i, result in enumerate(search_results["organic"][:depth]):
+    sources = results[:depth]
+    async def explore_source(url: str) -> Any:
+        html_content = await fetch_webpage_content(url)
+        if html_content.startswith("Error"):
+            return html_content
+        # Parse in a worker thread so other sources keep fetching meanwhile
+        return await asyncio.to_thread(parse_page, html_content)
+    # Fetch and parse all sources concurrently so latency is that of the slowest page
+    pages = await asyncio.gather(
+        *[explore_source(result.get('link', 'No link')) for result in sources],
+        return_exceptions=True
+    )
+    for i, (result, page) in enumerate(zip(sources, pages)):
         title = result.get('title', 'No title')
         url = result.get('link', 'No link')
         research_report.append(f"### Source {i+1}: {title}")
         research_report.append(f"URL: {url}\n")
-        # Get the content
-        html_content = await fetch_webpage_content(url)
-        if html_content.startswith("Error"):
-            research_report.append(f"Could not access this page: {html_content}\n")
+        if isinstance(page, BaseException):
+            page = f"Error fetching page: {str(page)}"
+        if isinstance(page, str):
+            research_report.append(f"Could not access this page: {page}\n")
             continue
-        soup = BeautifulSoup(html_content, 'html.parser')
-        # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.extract()
         # Extract headings for an outline
         research_report.append("#### Key Points:\n")
         headings = []
-        for tag in ['h1', 'h2', 'h3']:
-            for heading in soup.find_all(tag):
-                heading_text = heading.get_text(strip=True)
-                if heading_text and len(heading_text) > 3:  # Filter out too short headings
-                    headings.append(f"- {heading_text}")
+        for _, heading_text in page["headings"]:
+            if heading_text and len(heading_text) > 3:  # Filter out too short headings
+                headings.append(f"- {heading_text}")
+                if len(headings) >= MAX_KEY_POINTS:  # Stop at the first 10 qualifying headings
+                    break
         if headings:
-            research_report.extend(headings[:10])  # Limit to first 10 headings
+            research_report.extend(headings)
             research_report.append("")  # Empty line
         else:
             research_report.append("- No clear headings found on this page.")
             research_report.append("")  # Empty line
         # Try to get main content (simplified approach)
-        main_elements = soup.find_all(['article', 'main', 'div'], class_=lambda c: c and ('content' in c.lower() or 'article' in c.lower()))
         research_report.append("#### Summary of Content:\n")
-        if main_elements:
-            main_text = main_elements[0].get_text(separator=" ", strip=True)
+        if page["summary"]:
             # Create a simple summary by taking the first few paragraphs
-            paragraphs = main_text.split('\n')
-            content_summary = " ".join(paragraphs[:3])[:500] + "..."
+            content_summary = page["summary"] + "..."
+            research_report.append(content_summary)
+        elif page["main_text"]:
+            # Fall back to the start of the main content
+            content_summary = page["main_text"][:SUMMARY_LENGTH].replace("\n", " ") + "..."
             research_report.append(content_summary)
         else:
             # Fall back to page text
-            page_text = soup.get_text(separator=" ", strip=True)
-            content_summary = page_text[:500] + "..."
+            content_summary = page["full_text"][:SUMMARY_LENGTH].replace("\n", " ") + "..."
             research_report.append(content_summary)
         research_report.append("\n---\n")
     # Conclusion
     research_report.append("## Research Summary")
-    research_report.append(f"This research explored {depth} sources on the topic '{topic}'. To further explore this topic, consider reading the full content of the most relevant sources or refining your search terms.")
+    research_report.append(f"This research explored {len(sources)} sources on the topic '{topic}'. To further explore this topic, consider reading the full content of the most relevant sources or refining your search terms.")
     return "\n".join(research_report)
     
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import mock
+import httpx
+from bs4.element import Tag
+import search
+PAGE = """<html><head><title> Title </title><style>p { color: red; }</style></head>
+<body>
+  <div>
+    <ul>
+      <li>One</li>
+      <li>Two&nbsp;</li>
+    </ul>
+    <!-- comment -->
+    <p>Three
+      four</p>
+    <div class="Main-Content"> Main <b>text</b> </div>
+    <script>ignored()</script>
+  </div>
+</body></html>"""
+@unittest.skipIf(search.LexborHTMLParser is None, "selectolax is not installed")
+class ParserParityTest(unittest.TestCase):
+    """The Lexbor and BeautifulSoup parsers must extract the same text."""
+    def setUp(self):
+        self.lexbor = search.parse_with_lexbor(PAGE)
+        self.soup = search.parse_with_beautifulsoup(PAGE)
+    def test_full_text(self):
+        self.assertEqual(self.lexbor["full_text"], self.soup["full_text"])
+        self.assertNotIn("\n\n", self.lexbor["full_text"])
+    def test_main_text(self):
+        self.assertEqual(self.lexbor["main_text"], self.soup["main_text"])
+        self.assertEqual(self.lexbor["main_text"], "Main\ntext")
+    def test_nested_main_content_is_not_repeated(self):
+        page = '<main><div class="content"><p>Body</p></div></main><article>Other</article>'
+        self.assertEqual(search.parse_with_lexbor(page)["main_text"], "Body\n\nOther")
+        self.assertEqual(search.parse_with_beautifulsoup(page)["main_text"], "Body\n\nOther")
+    def test_summary(self):
+        page = '<nav><p>Cookie banner</p></nav><article><p>This is a <a href="/">link</a> in text.</p></article>'
+        self.assertEqual(search.parse_with_lexbor(page)["summary"], "This is a link in text.")
+        self.assertEqual(search.parse_with_beautifulsoup(page)["summary"], "This is a link in text.")
+        page = '<nav><p>Only <b>page</b> paragraph</p></nav>'
+        self.assertEqual(search.parse_with_lexbor(page)["summary"], "Only page paragraph")
+        self.assertEqual(search.parse_with_beautifulsoup(page)["summary"], "Only page paragraph")
+    def test_summary_stops_at_first_paragraphs(self):
+        page = "".join(f'<div class="content"><p>Paragraph {i} {"x" * 100}</p></div>' for i in range(1200))
+        expected = search.build_summary(f'Paragraph {i} {"x" * 100}' for i in range(5))
+        self.assertEqual(search.parse_with_lexbor(page)["summary"], expected)
+        find_all = Tag.find_all
+        paragraph_searches = []
+        def counting_find_all(tag, name=None, *args, **kwargs):
+            if name == 'p':
+                paragraph_searches.append(tag)
+            return find_all(tag, name, *args, **kwargs)
+        with mock.patch.object(Tag, "find_all", counting_find_all):
+            self.assertEqual(search.parse_with_beautifulsoup(page)["summary"], expected)
+        self.assertLessEqual(len(paragraph_searches), 5)
+    def test_summary_pulls_only_needed_paragraphs(self):
+        pulled = []
+        def paragraphs():
+            for i in range(1000):
+                pulled.append(i)
+                yield "x" * 100
+        search.build_summary(search.main_paragraphs_first(paragraphs(), lambda: self.fail("page paragraphs used")))
+        self.assertEqual(len(pulled), 5)
+class RetryTest(unittest.IsolatedAsyncioTestCase):
+    """send_with_retries retries 429/5xx responses with backoff outside the host semaphore."""
+    def setUp(self):
+        self.responses = []
+        self.requests = []
+        self.sleeps = []
+        search.fetch_webpage_content.cache_clear()
+        search.make_search_request.cache_clear()
+        transport = httpx.MockTransport(self.handle)
+        search.fetch_client = httpx.AsyncClient(transport=transport)
+        search.search_client = httpx.AsyncClient(transport=transport)
+        patcher = mock.patch("search.asyncio.sleep", self.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    async def asyncTearDown(self):
+        await search.fetch_client.aclose()
+        await search.search_client.aclose()
+        search.fetch_client = search.search_client = None
+    def handle(self, request):
+        self.requests.append(request)
+        return self.responses.pop(0)
+    async def sleep(self, delay):
+        # The backoff must not hold (or keep alive) the host's semaphore
+        self.assertNotIn("example.test", search.host_semaphores)
+        self.sleeps.append(delay)
+    async def test_retries_429_and_5xx(self):
+        self.responses = [httpx.Response(429), httpx.Response(503), httpx.Response(200, text="<p>ok</p>")]
+        self.assertEqual(await search.fetch_webpage_content("http://example.test/"), "<p>ok</p>")
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+    async def test_retries_search_requests(self):
+        self.responses = [httpx.Response(500), httpx.Response(200, json={"organic": []})]
+        self.assertEqual(await search.make_search_request("query"), {"organic": []})
+        self.assertEqual(len(self.requests), 2)
+    async def test_client_errors_are_not_retried(self):
+        self.responses = [httpx.Response(404)]
+        self.assertTrue((await search.fetch_webpage_content("http://example.test/")).startswith("Error"))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.sleeps, [])
+    async def test_gives_up_after_max_attempts(self):
+        self.responses = [httpx.Response(500) for _ in range(search.MAX_ATTEMPTS)]
+        self.assertTrue((await search.fetch_webpage_content("http://example.test/")).startswith("Error"))
+        self.assertEqual(len(self.requests), search.MAX_ATTEMPTS)
+        self.assertEqual(len(self.sleeps), search.MAX_ATTEMPTS - 1)
+    async def test_long_retry_after_is_not_retried(self):
+        self.responses = [httpx.Response(429, headers={"Retry-After": "120"})]
+        self.assertTrue((await search.fetch_webpage_content("http://example.test/")).startswith("Error"))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.sleeps, [])
+    def test_retry_after_parsing(self):
+        def delay(retry_after, attempt=0):
+            return search.get_retry_delay(httpx.Response(429, headers={"Retry-After": retry_after}), attempt)
+        self.assertEqual(delay("3"), 3.0)
+        self.assertIsNone(delay("120"))
+        retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+        self.assertTrue(8 <= delay(retry_at) <= 10)
+        self.assertEqual(delay(format_datetime(datetime(2000, 1, 1, tzinfo=timezone.utc), usegmt=True)), 0.0)
+        # Unparseable values fall back to capped exponential backoff
+        self.assertEqual(delay("soon", attempt=2), 2.0)
+        self.assertEqual(delay("soon", attempt=10), search.MAX_BACKOFF)
+class TtlCacheTest(unittest.IsolatedAsyncioTestCase):
+    """ttl_cache keeps successful results for ttl seconds in a bounded LRU."""
+    def setUp(self):
+        self.calls = []
+        @search.ttl_cache(maxsize=2, ttl=0.05, is_error=lambda result: result.startswith("Error"))
+        async def lookup(key):
+            self.calls.append(key)
+            return "Error" if key == "bad" else key.upper()
+        self.lookup = lookup
+    async def test_errors_are_not_cached(self):
+        self.assertEqual(await self.lookup("bad"), "Error")
+        self.assertEqual(await self.lookup("bad"), "Error")
+        self.assertEqual(self.calls, ["bad", "bad"])
+    async def test_results_expire_after_ttl(self):
+        self.assertEqual(await self.lookup("a"), "A")
+        self.assertEqual(await self.lookup("a"), "A")
+        self.assertEqual(self.calls, ["a"])
+        await asyncio.sleep(0.1)
+        self.assertEqual(await self.lookup("a"), "A")
+        self.assertEqual(self.calls, ["a", "a"])
+    async def test_least_recently_used_entry_is_evicted(self):
+        for key in ["a", "b", "a", "c"]:  # "b" is least recently used when "c" arrives
+            await self.lookup(key)
+        await self.lookup("a")
+        await self.lookup("b")
+        self.assertEqual(self.calls, ["a", "b", "c", "b"])
+class DeepResearchTest(unittest.IsolatedAsyncioTestCase):
+    """deep_research copes with incomplete Serper responses."""
+    async def research(self, search_results):
+        async def make_search_request(query, num_results=5):
+            return search_results
+        async def fetch_webpage_content(url):
+            return "<h1>Page heading</h1><p>Body</p>"
+        with mock.patch("search.make_search_request", make_search_request), \
+                mock.patch("search.fetch_webpage_content", fetch_webpage_content):
+            return await search.deep_research("topic", 2)
+    async def test_null_organic(self):
+        self.assertEqual(await self.research({"organic": None}), "No results found for your topic.")
+    async def test_null_link_is_skipped(self):
+        report = await self.research({"organic": [{"title": "No link", "link": None}, {"title": "Page", "link": "https://example.test/"}]})
+        self.assertNotIn("No link", report)
+        self.assertIn("### Source 1: Page", report)
+if __name__ == "__main__":
+    unittest.main()